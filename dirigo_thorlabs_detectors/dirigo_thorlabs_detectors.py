@@ -1,13 +1,60 @@
+import asyncio
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from functools import lru_cache
+
 import serial
+import serial.tools.list_ports
 import pyvisa
+from pyvisa.constants import EventMechanism, EventType, StatusCode
+from pyvisa.errors import VisaIOError
 
 from dirigo import units
 from dirigo.hw_interfaces.detector import Detector
 
 
+logger = logging.getLogger(__name__)
+
+
+# PMT2100 SCPI commands (short-form mnemonics). Parameterised commands are
+# bound str.format methods, so building one is a single call.
+_CMD_SENSOR_GET = "SENS:DET?"
+_CMD_HV_STATE_GET_FMT = "SENS:FUNC:STAT? {}".format
+_CMD_HV_ON_FMT = "SENS:FUNC:ON {}".format
+_CMD_HV_OFF_FMT = "SENS:FUNC:OFF {}".format
+_CMD_INST_SEL_FMT = "INST:SEL {}".format
+_CMD_INST_SEL_THEN_FMT = "INST:SEL {};{}".format  # select + command, one transfer
+_CMD_GAIN_GET = ":SOUR:VOLT:LEV:IMM:AMPL?"
+_CMD_GAIN_SET_FMT = ":SOUR:VOLT:LEV:IMM:AMPL {:.6g}".format
+_CMD_BW_GET = ":SENS:FILT:LPAS:FREQ?"
+_CMD_BW_SET_FMT = ":SENS:FILT:LPAS:FREQ {:.6g}".format
+
+
+# One VISA ResourceManager shared by all instruments (loading the VISA
+# library is slow, so do it once per process)
+_RM: pyvisa.ResourceManager | None = None
+_RM_LOCK = threading.Lock()
+
+
+def _get_rm() -> pyvisa.ResourceManager:
+    global _RM
+    with _RM_LOCK:
+        if _RM is None:
+            _RM = pyvisa.ResourceManager()  # Uses the system VISA (Keysight/NI)
+        return _RM
+
+
 
 class PDA40(Detector):
     """Thorlabs PDA40-series Silicon Photomultiplier Modules."""
+    __slots__ = ("_model", "_index")
+
+    _GAIN_RANGE = units.IntRange(min=0, max=9) # manually set positions
+    _BANDWIDTH = units.Frequency("100 MHz") # 3dB cutoff for the measured ~4.5 ns pulse assuming Gaussian pulse shape
+
     def __init__(self, model: str, **kwargs):
         super().__init__()
         self._model = model
@@ -31,12 +78,12 @@ class PDA40(Detector):
     
     @property
     def gain_range(self):
-        return units.IntRange(min=0, max=9) # manually set positions
+        return self._GAIN_RANGE
 
     @property
     def bandwidth(self) -> units.Frequency: 
         """Switchable bandwidth; raise NotImplementedError if fixed."""
-        return units.Frequency("100 MHz") # 3dB cutoff for the measured ~4.5 ns pulse assuming Gaussian pulse shape
+        return self._BANDWIDTH
 
     @bandwidth.setter
     def bandwidth(self, value: units.Frequency):
@@ -44,54 +91,356 @@ class PDA40(Detector):
 
 
 
+_THORLABS_VID = 0x1313
+_PMT2100_PID = 0x2F00
+
+
+@lru_cache(maxsize=64)
+def _encode_cmd(cmd: str) -> bytes:
+    """Terminated ASCII bytes for a SCPI command (cached for repeated commands)."""
+    return (cmd.strip() + "\n").encode("ascii")
+
+
+def _find_serial_port(serial_number: int) -> str | None:
+    """Return the virtual COM port of a PMT2100 controller, or None if absent."""
+    for port in serial.tools.list_ports.comports():
+        if port.vid != _THORLABS_VID or port.serial_number != str(serial_number):
+            continue
+        # other Thorlabs devices may share the serial number; require the
+        # PMT2100 PID or a product string naming it
+        if port.pid == _PMT2100_PID or "PMT" in (port.product or "").upper():
+            return port.device
+    return None
+
+
+class _SCPITransport(ABC):
+    """Line-oriented SCPI link to an instrument."""
+
+    @property
+    @abstractmethod
+    def timeout(self) -> float:
+        """I/O timeout in seconds."""
+        ...
+
+    @timeout.setter
+    @abstractmethod
+    def timeout(self, value: float) -> None: ...
+
+    @abstractmethod
+    def write(self, cmd: str) -> None: ...
+
+    @abstractmethod
+    def query(self, cmd: str) -> str:
+        """
+        Write `cmd` and return the response line without terminator.
+
+        Raises the built-in TimeoutError if no response arrives within
+        `timeout`, whichever transport is in use.
+        """
+        ...
+
+    @abstractmethod
+    def wait_opc(self) -> None:
+        """Block until pending commands have completed (TimeoutError if not)."""
+        ...
+
+    @abstractmethod
+    def close(self) -> None: ...
+
+
+class _PyvisaTransport(_SCPITransport):
+    """SCPI over USBTMC through the system VISA library."""
+    SRQ_PROBE_TIMEOUT = 0.5 # s, wait for the test SRQ at connect
+    # TODO figure out why self._res not getting correct type hints
+    # possibly need to provide resource_pyclass to ResourceManager.open_resource()
+
+    def __init__(self, resource_name: str, timeout: float) -> None:
+        self._res = _get_rm().open_resource(resource_name)
+        self._res.timeout = int(1000*timeout)
+        # End reads on the newline terminator rather than waiting on END/timeout
+        self._res.read_termination = "\n"  # type: ignore
+        self._res.write_termination = "\n"  # type: ignore
+        self._res.query_delay = 0.0  # type: ignore
+
+        # Raise a service request when *OPC sets Operation Complete (ESE bit 0
+        # -> ESB, SRE bit 5) so wait_opc() can block on the event, not poll *STB?
+        # Best effort: not every VISA backend/firmware supports USB488 SRQ.
+        self._srq = False
+        try:
+            self._res.write("*CLS;*ESE 1;*SRE 32")  # type: ignore
+            self._res.enable_event(EventType.service_request, EventMechanism.queue)  # type: ignore
+        except (VisaIOError, NotImplementedError):
+            logger.debug("SRQ unavailable on %s, wait_opc will query *OPC?", resource_name)
+        else:
+            self._srq = self._probe_srq()
+
+    def _probe_srq(self) -> bool:
+        """
+        Check that an SRQ actually arrives: some firmware accepts the event
+        setup but never sends USB488 interrupts, which would make every
+        wait_opc() run into its timeout.
+        """
+        previous = self._res.timeout
+        self._res.timeout = int(1000*self.SRQ_PROBE_TIMEOUT)
+        self._srq = True
+        try:
+            self.wait_opc()
+            return True
+        except TimeoutError:
+            logger.debug("No SRQ from %s, wait_opc will query *OPC?", self._res.resource_name)
+            try:
+                self._res.disable_event(EventType.service_request, EventMechanism.queue)  # type: ignore
+            except (VisaIOError, NotImplementedError):
+                pass
+            return False
+        finally:
+            self._res.timeout = previous
+
+    @property
+    def timeout(self) -> float:
+        return self._res.timeout / 1000
+
+    @timeout.setter
+    def timeout(self, value: float) -> None:
+        self._res.timeout = int(1000*value)
+
+    def write(self, cmd: str) -> None:
+        self._res.write(cmd) # type: ignore
+
+    @contextmanager
+    def _timeout_as_builtin(self, what: str):
+        """Re-raise VISA timeouts as TimeoutError, the transport-level contract."""
+        try:
+            yield
+        except VisaIOError as e:
+            if e.error_code == StatusCode.error_timeout:
+                raise TimeoutError(f"No response to {what!r} on {self._res.resource_name}") from e
+            raise
+
+    def query(self, cmd: str) -> str:
+        with self._timeout_as_builtin(cmd):
+            return self._res.query(cmd) # type: ignore
+
+    def wait_opc(self) -> None:
+        if not self._srq:
+            self.query("*OPC?")
+            return
+        # Clear ESR (and with it ESB) first, so a previous timed-out wait
+        # can't leave the OPC bit set and suppress this SRQ edge
+        self.query("*ESR?")
+        self._res.discard_events(EventType.service_request, EventMechanism.queue) # type: ignore
+        self._res.write("*OPC") # type: ignore
+        with self._timeout_as_builtin("*OPC"):
+            self._res.wait_on_event(EventType.service_request, self._res.timeout) # type: ignore
+
+    def close(self) -> None:
+        self._res.close()
+
+
+class _PyserialTransport(_SCPITransport):
+    """SCPI over the instrument's USB CDC virtual COM port."""
+
+    def __init__(self, port: str, timeout: float) -> None:
+        self._ser = serial.Serial(port, baudrate=115200, timeout=timeout,
+                                  write_timeout=timeout)
+        try:
+            # Linux only: poll the USB endpoint every 1 ms rather than 16 ms
+            self._ser.set_low_latency_mode(True)
+        except (AttributeError, OSError, ValueError):
+            pass # not available on this platform/driver
+        if hasattr(self._ser, "set_buffer_size"):
+            # Windows only: larger driver buffers so a write_batch() goes out
+            # as one transfer
+            self._ser.set_buffer_size(rx_size=4096, tx_size=4096)
+
+    @property
+    def timeout(self) -> float:
+        return self._ser.timeout
+
+    @timeout.setter
+    def timeout(self, value: float) -> None:
+        self._ser.timeout = value
+        self._ser.write_timeout = value
+
+    def write(self, cmd: str) -> None:
+        self._ser.write(_encode_cmd(cmd))
+
+    def query(self, cmd: str) -> str:
+        # Drop any late reply to an earlier timed-out query so responses
+        # stay paired with their commands
+        self._ser.reset_input_buffer()
+        self._ser.write(_encode_cmd(cmd))
+        line = self._ser.read_until(b"\n")
+        if not line.endswith(b"\n"):
+            raise TimeoutError(f"No response to {cmd!r} on {self._ser.port}")
+        return line.decode("ascii").strip()
+
+    def wait_opc(self) -> None:
+        self.query("*OPC?")
+
+    def close(self) -> None:
+        self._ser.close()
+
+
 class PMT2100(Detector): 
     """
     Thorlabs PMT2101 controller via SCPI over USB.
 
-    Requires Keysight VISA-compatible driver so the device
-    appears as a serial port.
+    Uses the controller's virtual COM port when one is present, otherwise
+    USBTMC through VISA (requires a Keysight/NI VISA-compatible driver).
     """
-    # TODO figure out why self._res not getting correct type hints
-    # possibly need to provide resource_pyclass to ResourceManager.open_resource()
+    __slots__ = (
+        "_transport", "_idn", "_sensor", "_selected_inst",
+        "_enabled_cached", "_enabled_ts", "_lock", "_index",
+    )
+
+    # Send ';'-joined SCPI commands in a single transfer. Override with False
+    # for firmware that rejects compound commands (falls back to sequential).
+    SUPPORTS_COMPOUND = True
+
+    # How long (s) a known HV state is trusted before the enabled getter
+    # queries the instrument again
+    ENABLED_CACHE_TTL = 0.5
+
+    # Timeout for waits on command completion, which outlast ordinary I/O
+    SYNC_TIMEOUT = units.Time("5 s")
+
+    _GAIN_RANGE = units.VoltageRange(min="0.5 V", max="1 V")
+    _ALLOWED_BW = frozenset((
+        units.Frequency("80 MHz"),
+        units.Frequency("2.5 MHz"),
+        units.Frequency("0.25 MHz"),
+    ))
 
     def __init__(
         self,
         serial_number: int,
-        timeout: float = units.Time("1 s"),
+        timeout: float = units.Time("100 ms"),
+        transport: str = "auto",
         **kwargs
     ) -> None:
         super().__init__()
-        
-        rm = pyvisa.ResourceManager()        # Uses the system VISA (Keysight/NI)
-        
-        self._res = rm.open_resource(f"USB0::0x1313::0x2F00::{serial_number}::0::INSTR")
-        self._res.timeout = int(1000*timeout)
-     
-        self._sensor = self._res.query("SENS:DET?")  # type: ignore
+
+        # Serialises transport I/O and the cached state below, so sync callers
+        # and the async wrappers' executor threads can share one instrument
+        self._lock = threading.RLock()
+
+        if transport not in ("auto", "serial", "visa"):
+            raise ValueError("transport must be one of: 'auto', 'serial', 'visa'")
+        self._connect(serial_number, timeout, transport)
+
+        # Static device metadata, queried once per session (*IDN? in _connect)
+        self._sensor = self._transport.query(_CMD_SENSOR_GET)
         # above line returns the sensor name, e.g. 'H10721'
 
+        self._selected_inst: str | None = None  # last INST:SEL sent, None if unknown
+        self._enabled_cached: bool | None = None  # last known HV state
+        self._enabled_ts = 0.0
+
         self._index = -1  # will be set by DetectorSet
 
+    def _connect(self, serial_number: int, timeout: float, transport: str) -> None:
+        """
+        Open the transport and read *IDN?. "auto" prefers native serial
+        (several times faster than USBTMC) and falls back to VISA if the port
+        can't be opened or doesn't answer like a PMT2100.
+        """
+        self._transport: _SCPITransport
+        port = _find_serial_port(serial_number) if transport != "visa" else None
+        if port is None and transport == "serial":
+            raise RuntimeError(f"No virtual COM port found for PMT2100 {serial_number}")
+
+        if port is not None:
+            if transport == "serial":
+                self._transport = _PyserialTransport(port, timeout)
+                self._idn = self._transport.query("*IDN?")
+                return
+            ser = None
+            try:
+                ser = _PyserialTransport(port, timeout)
+                idn = ser.query("*IDN?")
+                if "PMT" not in idn.upper():
+                    raise ValueError(f"unexpected *IDN? response {idn!r}")
+                self._transport, self._idn = ser, idn
+                return
+            except (serial.SerialException, TimeoutError, ValueError) as e:
+                # ValueError also covers non-ASCII (UnicodeDecodeError) replies
+                logger.debug("Serial port %s unusable (%s), falling back to VISA", port, e)
+                if ser is not None:
+                    ser.close()
+
+        self._transport = _PyvisaTransport(
+            f"USB0::0x1313::0x2F00::{serial_number}::0::INSTR", timeout
+        )
+        self._idn = self._transport.query("*IDN?")
+
     def close(self) -> None:
-        """Close the serial port when done."""
-        self._res.close()
+        """Close the connection when done."""
+        with self._lock:
+            self._selected_inst = None
+            self._enabled_cached = None
+            self._transport.close()
+
+    @contextmanager
+    def _timeout(self, timeout: float):
+        """Temporarily use a longer I/O timeout (seconds) for slow operations."""
+        previous = self._transport.timeout
+        self._transport.timeout = timeout
+        try:
+            yield
+        finally:
+            self._transport.timeout = previous
+
+    def _select_inst(self, name: str) -> None:
+        """Send INST:SEL, skipping the write if `name` is already selected."""
+        if self._selected_inst != name:
+            self._transport.write(_CMD_INST_SEL_FMT(name))
+            self._selected_inst = name
+
+    def _inst_write(self, name: str, cmd: str) -> None:
+        """Write `cmd` with instrument `name` selected."""
+        if self.SUPPORTS_COMPOUND and self._selected_inst != name:
+            self._transport.write(_CMD_INST_SEL_THEN_FMT(name, cmd))
+            self._selected_inst = name
+        else:
+            self._select_inst(name)
+            self._transport.write(cmd)
+
+    def _inst_query(self, name: str, cmd: str) -> str:
+        """Query `cmd` with instrument `name` selected."""
+        if self.SUPPORTS_COMPOUND and self._selected_inst != name:
+            resp = self._transport.query(_CMD_INST_SEL_THEN_FMT(name, cmd))
+            self._selected_inst = name
+            return resp
+        self._select_inst(name)
+        return self._transport.query(cmd)
 
     # ------------------------------------------------------ Detector API
     @property
     def enabled(self) -> bool:
         """Turns the PMT high-voltage on/off."""
-        resp = self._res.query(f"SENS:FUNC:STAT? {self._sensor}") # type: ignore
-        # device returns "1" for on, "0" for off
-        print(resp)
-        return resp == "1"
+        with self._lock:
+            if (self._enabled_cached is not None
+                    and time.monotonic() - self._enabled_ts < self.ENABLED_CACHE_TTL):
+                return self._enabled_cached
+            resp = self._transport.query(_CMD_HV_STATE_GET_FMT(self._sensor))
+            # device returns "1" for on, "0" for off
+            logger.debug("enabled resp=%s", resp)
+            self._enabled_cached = resp == "1"
+            self._enabled_ts = time.monotonic()
+            return self._enabled_cached
 
     @enabled.setter
     def enabled(self, state: bool) -> None:
         if state:
-            cmd = f"SENS:FUNC:ON {self._sensor}"  
+            cmd = _CMD_HV_ON_FMT(self._sensor)
         else:
-            cmd = f"SENS:FUNC:OFF {self._sensor}"
-        self._res.write(cmd) # type: ignore
+            cmd = _CMD_HV_OFF_FMT(self._sensor)
+        with self._lock:
+            self._transport.write(cmd)
+            self._selected_inst = None  # switching HV may reset the selection
+            self._enabled_cached = bool(state)
+            self._enabled_ts = time.monotonic()
 
     # TODO, add offset, bias
 
@@ -100,21 +449,17 @@ class PMT2100(Detector):
         """
         PMT gain (really the gain control voltage) in volts.
         """
-        self._res.write("INST:SEL GAIN") # type: ignore
-        resp = self._res.query(":SOUR:VOLT:LEV:IMM:AMPL?") # type: ignore
-        return units.Voltage(resp)
+        with self._lock:
+            resp = self._inst_query("GAIN", _CMD_GAIN_GET)
+        return units.Voltage(float(resp))  # response is a bare number in volts
 
     @gain.setter
     def gain(self, value) -> None:
-        if not self.gain_range.within_range(value):
-            l, h = self.gain_range.min, self.gain_range.max
-            raise ValueError(f"Gain voltage must be between {l} and {h}")
-        self._res.write("INST:SEL GAIN") # type: ignore
-        self._res.write(f":SOUR:VOLT:LEV:IMM:AMPL {float(value)}") # type: ignore
+        self.set_gain(value)
 
     @property
     def gain_range(self) -> units.VoltageRange:
-        return units.VoltageRange(min="0.5 V", max="1 V")
+        return self._GAIN_RANGE
 
     @property
     def bandwidth(self) -> units.Frequency:
@@ -122,21 +467,102 @@ class PMT2100(Detector):
         Low-pass filter corner frequency.
         Supported values: 80, 2.5, 0.25 MHz
         """
-        resp = self._res._query(":SENSe:FILTer:LPASs:FREQuency?") # type: ignore
-        return units.Frequency(resp)
+        with self._lock:
+            resp = self._transport.query(_CMD_BW_GET)
+        return units.Frequency(float(resp))
 
     @bandwidth.setter
     def bandwidth(self, freq: units.Frequency) -> None:
-        if freq not in (units.Frequency("80 MHz"), units.Frequency("2.5 MHz"), units.Frequency("0.25 MHz")):
+        if freq not in self._ALLOWED_BW:
             raise ValueError("Bandwidth must be one of: 80, 2.5, 0.25 (MHz)")
-        self._res._write(f":SENSe:FILTer:LPASs:FREQuency {freq}") # type: ignore
+        with self._lock:
+            self._transport.write(_CMD_BW_SET_FMT(float(freq)))
 
     # ---------------------------------------------------- Optional helpers
     def identify(self) -> str:
-        """Query the instrument identity string."""
-        return self._res.query("*IDN?") # type: ignore
+        """Return the instrument identity string (queried once at connect)."""
+        return self._idn
+
+    def set_gain(self, value, sync: bool = False) -> None:
+        """
+        Set the gain control voltage. With `sync`, block until the instrument
+        reports the command complete (use at the end of a batch of settings).
+        """
+        if not self.gain_range.within_range(value):
+            l, h = self.gain_range.min, self.gain_range.max
+            raise ValueError(f"Gain voltage must be between {l} and {h}")
+        with self._lock:
+            self._inst_write("GAIN", _CMD_GAIN_SET_FMT(float(value)))
+            if sync:
+                self.wait_opc()
+
+    def write_batch(self, cmds: list[str]) -> None:
+        """
+        Write several SCPI commands in one transfer (sequentially if the
+        instrument does not support compound commands). Blank entries are
+        skipped; queries are rejected since their responses would go unread
+        (send them individually, e.g. with `aquery`).
+        """
+        cmds = [c.strip() for c in cmds if c.strip()]
+        for c in cmds:
+            # an entry may itself be compound; check every header in it
+            for part in c.split(";"):
+                header = part.strip().split(None, 1)[0] if part.strip() else ""
+                if header.endswith("?"):
+                    raise ValueError(f"write_batch can not send queries (got {c!r})")
+        if not cmds:
+            return
+        with self._lock:
+            if self.SUPPORTS_COMPOUND:
+                # root every subcommand so it doesn't resolve relative to the last
+                self._transport.write(";".join(
+                    c if c.startswith((":", "*")) else ":" + c for c in cmds
+                ))
+            else:
+                for c in cmds:
+                    self._transport.write(c)
+            # arbitrary commands may change the selection or HV state
+            self._selected_inst = None
+            self._enabled_cached = None
+
+    def _query_any(self, cmd: str) -> str:
+        """Send an arbitrary SCPI query (may change the selection or HV state)."""
+        with self._lock:
+            resp = self._transport.query(cmd)
+            self._selected_inst = None
+            self._enabled_cached = None
+            return resp
+
+    # Async wrappers: transport I/O is blocking, so run the I/O on the default executor
+    # to let several detectors be configured concurrently, e.g.
+    #   await asyncio.gather(d1.aset_gain(v), d2.aset_gain(v))
+    # Calls on one instrument are serialised by its lock.
+    async def aquery(self, cmd: str) -> str:
+        """Send an arbitrary SCPI query without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._query_any, cmd)
+
+    async def aset_gain(self, value, sync: bool = False) -> None:
+        """Async version of `set_gain`."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.set_gain, value, sync)
+
+    def wait_opc(self, timeout: float | None = None) -> None:
+        """
+        Block until pending commands complete, for up to `timeout` seconds
+        (default SYNC_TIMEOUT). Over VISA this waits on the service request
+        event rather than polling the status byte.
+        """
+        with self._lock:
+            with self._timeout(self.SYNC_TIMEOUT if timeout is None else timeout):
+                self._transport.wait_opc()
 
     def status_byte(self) -> int:
-        """Read the 488.2 status byte."""
-        resp = self._res.query("*STB?") # type: ignore
+        """
+        Read the 488.2 status byte. Over VISA with SRQ enabled (*SRE 32), RQS/MSS
+        (bit 6) and ESB (bit 5) are reported set after each *OPC completes
+        until wait_opc() next clears the event status register.
+        """
+        with self._lock:
+            resp = self._transport.query("*STB?")
         return int(resp)
\ No newline at end of file
@@ -0,0 +1,287 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from dirigo import units
+
+import dirigo_thorlabs_detectors.dirigo_thorlabs_detectors as dtd
+from dirigo_thorlabs_detectors import PMT2100
+
+
+class MockTransport(dtd._SCPITransport):
+    """Records SCPI traffic and answers the queries PMT2100 sends."""
+
+    def __init__(self, *args, **kwargs):
+        self.log: list[tuple[str, str]] = []
+        self.hv_state = "0"
+        self._timeout = 0.1
+
+    @property
+    def timeout(self) -> float:
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value: float) -> None:
+        self._timeout = value
+
+    def write(self, cmd: str) -> None:
+        self.log.append(("w", cmd))
+
+    def query(self, cmd: str) -> str:
+        self.log.append(("q", cmd))
+        if cmd == "*IDN?":
+            return "THORLABS,PMT2100,123,1.0"
+        if cmd == "SENS:DET?":
+            return "H10721"
+        if cmd.endswith("AMPL?"):
+            return "5.0E-1"
+        if cmd.startswith("SENS:FUNC:STAT?"):
+            return self.hv_state
+        if cmd.endswith("FREQ?"):
+            return "2.5E6"
+        return "1"
+
+    def wait_opc(self) -> None:
+        self.query("*OPC?")
+
+    def close(self) -> None:
+        pass
+
+
+@pytest.fixture
+def pmt(monkeypatch):
+    monkeypatch.setattr(dtd, "_find_serial_port", lambda serial_number: None)
+    monkeypatch.setattr(dtd, "_PyvisaTransport", MockTransport)
+    detector = PMT2100(123)
+    detector._transport.log.clear()
+    return detector
+
+
+def inst_selects(log):
+    return [cmd for _, cmd in log if "INST:SEL" in cmd]
+
+
+def test_inst_sel_sent_once(pmt):
+    pmt.gain = units.Voltage("0.7 V")
+    pmt.gain
+    pmt.gain = units.Voltage("0.8 V")
+
+    assert pmt._transport.log == [
+        ("w", "INST:SEL GAIN;:SOUR:VOLT:LEV:IMM:AMPL 0.7"),
+        ("q", ":SOUR:VOLT:LEV:IMM:AMPL?"),
+        ("w", ":SOUR:VOLT:LEV:IMM:AMPL 0.8"),
+    ]
+
+
+def test_inst_sel_resent_after_enabled(pmt):
+    pmt.gain = units.Voltage("0.7 V")
+    pmt.enabled = True
+    pmt.gain = units.Voltage("0.7 V")
+
+    assert len(inst_selects(pmt._transport.log)) == 2
+
+
+def test_inst_sel_resent_after_write_batch(pmt):
+    pmt.gain = units.Voltage("0.7 V")
+    pmt.write_batch(["SENS:FUNC:ON H10721"])
+    pmt.gain = units.Voltage("0.7 V")
+
+    assert len(inst_selects(pmt._transport.log)) == 2
+
+
+def test_sequential_fallback(pmt, monkeypatch):
+    monkeypatch.setattr(PMT2100, "SUPPORTS_COMPOUND", False)
+    pmt.gain = units.Voltage("0.7 V")
+    pmt.gain
+    pmt.write_batch(["SENS:FUNC:ON H10721", "*OPC"])
+
+    assert pmt._transport.log == [
+        ("w", "INST:SEL GAIN"),
+        ("w", ":SOUR:VOLT:LEV:IMM:AMPL 0.7"),
+        ("q", ":SOUR:VOLT:LEV:IMM:AMPL?"),
+        ("w", "SENS:FUNC:ON H10721"),
+        ("w", "*OPC"),
+    ]
+
+
+def test_serial_transport_requires_port(monkeypatch):
+    monkeypatch.setattr(dtd, "_find_serial_port", lambda serial_number: None)
+    monkeypatch.setattr(dtd, "_PyvisaTransport", MockTransport)
+    with pytest.raises(RuntimeError):
+        PMT2100(123, transport="serial")
+
+
+def test_enabled_cache_ttl(pmt, monkeypatch):
+    now = 100.0
+    monkeypatch.setattr(dtd, "time", SimpleNamespace(monotonic=lambda: now))
+    queries = lambda: [c for k, c in pmt._transport.log if k == "q"]
+
+    pmt.enabled = True
+    assert pmt.enabled is True
+    assert queries() == []  # served from the cache
+
+    now += PMT2100.ENABLED_CACHE_TTL + 0.1
+    pmt._transport.hv_state = "0"  # e.g. tripped by overload protection
+    assert pmt.enabled is False
+    assert queries() == ["SENS:FUNC:STAT? H10721"]
+
+
+class SerialOpenFails(MockTransport):
+    def __init__(self, *args, **kwargs):
+        raise dtd.serial.SerialException("port busy")
+
+
+class SerialNoReply(MockTransport):
+    closed = False
+
+    def query(self, cmd: str) -> str:
+        raise TimeoutError(cmd)
+
+    def close(self) -> None:
+        SerialNoReply.closed = True
+
+
+class SerialNotSCPI(MockTransport):
+    def query(self, cmd: str) -> str:
+        return "garbage"
+
+
+@pytest.mark.parametrize("serial_cls", [SerialOpenFails, SerialNoReply, SerialNotSCPI])
+def test_auto_falls_back_to_visa(monkeypatch, serial_cls):
+    monkeypatch.setattr(dtd, "_find_serial_port", lambda serial_number: "/dev/ttyACM0")
+    monkeypatch.setattr(dtd, "_PyserialTransport", serial_cls)
+    monkeypatch.setattr(dtd, "_PyvisaTransport", MockTransport)
+
+    detector = PMT2100(123)
+
+    assert type(detector._transport) is MockTransport
+    assert detector.identify() == "THORLABS,PMT2100,123,1.0"
+    if serial_cls is SerialNoReply:
+        assert SerialNoReply.closed
+
+
+def test_forced_serial_does_not_fall_back(monkeypatch):
+    monkeypatch.setattr(dtd, "_find_serial_port", lambda serial_number: "/dev/ttyACM0")
+    monkeypatch.setattr(dtd, "_PyserialTransport", SerialNoReply)
+    monkeypatch.setattr(dtd, "_PyvisaTransport", MockTransport)
+
+    with pytest.raises(TimeoutError):
+        PMT2100(123, transport="serial")
+
+
+def test_find_serial_port_requires_pmt2100(monkeypatch):
+    def port(device, pid, product=None, serial_number="123"):
+        return SimpleNamespace(device=device, vid=dtd._THORLABS_VID, pid=pid,
+                               product=product, serial_number=serial_number)
+
+    ports = [
+        port("/dev/ttyACM0", pid=0x8001),                     # other Thorlabs device
+        port("/dev/ttyACM1", pid=0x1234, serial_number="9"),  # other serial number
+        port("/dev/ttyACM2", pid=0x1234, product="PMT2100 Controller"),
+    ]
+    monkeypatch.setattr(dtd.serial.tools.list_ports, "comports", lambda: ports)
+    assert dtd._find_serial_port(123) == "/dev/ttyACM2"
+
+    ports[2] = port("/dev/ttyACM2", pid=dtd._PMT2100_PID)
+    assert dtd._find_serial_port(123) == "/dev/ttyACM2"
+
+    del ports[2]
+    assert dtd._find_serial_port(123) is None
+
+
+def test_aquery_invalidates_cached_state(pmt):
+    pmt.gain = units.Voltage("0.7 V")
+    pmt.enabled = True
+
+    assert asyncio.run(pmt.aquery("*RST;*OPC?")) == "1"
+    assert pmt._selected_inst is None
+    assert pmt._enabled_cached is None
+
+
+def test_calls_on_one_instrument_do_not_overlap(pmt):
+    in_flight, overlaps = [0], []
+    query = pmt._transport.query
+
+    def slow_query(cmd):
+        in_flight[0] += 1
+        overlaps.append(in_flight[0] > 1)
+        time.sleep(0.01)
+        in_flight[0] -= 1
+        return query(cmd)
+
+    pmt._transport.query = slow_query
+
+    async def main():
+        await asyncio.gather(*(pmt.aquery("*STB?") for _ in range(5)),
+                             asyncio.to_thread(lambda: pmt.gain))
+
+    asyncio.run(main())
+    assert len(overlaps) == 6 and not any(overlaps)
+
+
+def test_write_batch_skips_blank_commands(pmt):
+    pmt.write_batch(["SENS:FUNC:ON H10721", "", "  ", "*OPC"])
+    pmt.write_batch(["", " "])
+
+    assert pmt._transport.log == [("w", ":SENS:FUNC:ON H10721;*OPC")]
+
+
+@pytest.mark.parametrize("cmds", [
+    ["*OPC?"],
+    ["SENS:FUNC:STAT? H10721"],
+    ["SENS:FUNC:ON H10721", "B?;A"],
+    ["A; *STB?"],
+])
+def test_write_batch_rejects_queries(pmt, cmds):
+    with pytest.raises(ValueError):
+        pmt.write_batch(cmds)
+    assert pmt._transport.log == []
+
+
+def test_wait_opc_uses_sync_timeout(pmt):
+    seen = []
+    pmt._transport.wait_opc = lambda: seen.append(pmt._transport.timeout)
+
+    pmt.wait_opc()
+    pmt.wait_opc(timeout=1.0)
+    pmt.set_gain(units.Voltage("0.7 V"), sync=True)
+
+    assert seen == [PMT2100.SYNC_TIMEOUT, 1.0, PMT2100.SYNC_TIMEOUT]
+    assert pmt._transport.timeout == 0.1
+
+
+def test_bandwidth_get(pmt):
+    assert pmt.bandwidth == units.Frequency("2.5 MHz")
+    assert pmt._transport.log == [("q", ":SENS:FILT:LPAS:FREQ?")]
+
+
+def test_bandwidth_set(pmt):
+    pmt.bandwidth = units.Frequency("80 MHz")
+
+    assert pmt._transport.log == [("w", ":SENS:FILT:LPAS:FREQ 8e+07")]
+
+
+def test_bandwidth_set_rejects_unsupported(pmt):
+    with pytest.raises(ValueError):
+        pmt.bandwidth = units.Frequency("10 MHz")
+    assert pmt._transport.log == []
+
+
+def test_gain_parses_bare_numeric_response(pmt):
+    gain = pmt.gain  # instrument answers "5.0E-1", no unit suffix
+
+    assert isinstance(gain, units.Voltage)
+    assert gain == units.Voltage("500 mV")
+
+
+def test_timeout_context_restores_previous(pmt):
+    with pmt._timeout(2.0):
+        assert pmt._transport.timeout == 2.0
+    assert pmt._transport.timeout == 0.1
+
+    with pytest.raises(TimeoutError):
+        with pmt._timeout(2.0):
+            raise TimeoutError
+    assert pmt._transport.timeout == 0.1
@@ -0,0 +1,167 @@
+import pytest
+from pyvisa.constants import StatusCode
+from pyvisa.errors import VisaIOError
+
+import dirigo_thorlabs_detectors.dirigo_thorlabs_detectors as dtd
+
+
+class FakeSerial:
+    """Stands in for serial.Serial; `replies` are returned by read_until."""
+
+    def __init__(self, port, **kwargs):
+        self.port = port
+        self.timeout = kwargs.get("timeout")
+        self.write_timeout = kwargs.get("write_timeout")
+        self.written: list[bytes] = []
+        self.rx = b""  # bytes waiting in the input buffer
+        self.replies: dict[bytes, bytes] = {}
+
+    def set_low_latency_mode(self, enabled):
+        raise ValueError("not supported")
+
+    def reset_input_buffer(self):
+        self.rx = b""
+
+    def write(self, data):
+        self.written.append(data)
+        self.rx += self.replies.get(data, b"")
+
+    def read_until(self, expected):
+        line, sep, rest = self.rx.partition(expected)
+        self.rx = rest
+        return line + sep
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def serial_transport(monkeypatch):
+    monkeypatch.setattr(dtd.serial, "Serial", FakeSerial)
+    return dtd._PyserialTransport("/dev/ttyACM0", 0.1)
+
+
+def test_serial_query_strips_terminator(serial_transport):
+    ser = serial_transport._ser
+    ser.replies[b"*IDN?\n"] = b"THORLABS,PMT2100,123,1.0\r\n"
+
+    assert serial_transport.query("*IDN?") == "THORLABS,PMT2100,123,1.0"
+    assert ser.written == [b"*IDN?\n"]
+
+
+def test_serial_query_without_terminator_times_out(serial_transport):
+    serial_transport._ser.replies[b"*IDN?\n"] = b"THORLABS,PMT"  # truncated
+
+    with pytest.raises(TimeoutError):
+        serial_transport.query("*IDN?")
+
+
+def test_serial_query_drops_stale_reply(serial_transport):
+    ser = serial_transport._ser
+    ser.rx = b"late reply\n"  # answer to an earlier, timed-out query
+    ser.replies[b"*STB?\n"] = b"0\n"
+
+    assert serial_transport.query("*STB?") == "0"
+
+
+class FakeResource:
+    """Stands in for a pyvisa USBTMC resource."""
+
+    resource_name = "USB0::0x1313::0x2F00::123::0::INSTR"
+
+    def __init__(self):
+        self.timeout = 100
+        self.log: list[tuple] = []
+        self.srq_supported = True
+        self.srq_arrives = True
+        self.query_error: VisaIOError | None = None
+
+    def write(self, cmd):
+        self.log.append(("w", cmd))
+
+    def query(self, cmd):
+        self.log.append(("q", cmd))
+        if self.query_error is not None:
+            raise self.query_error
+        return "1"
+
+    def enable_event(self, event_type, mechanism):
+        if not self.srq_supported:
+            raise NotImplementedError
+        self.log.append(("enable_event",))
+
+    def discard_events(self, event_type, mechanism):
+        self.log.append(("discard_events",))
+
+    def disable_event(self, event_type, mechanism):
+        self.log.append(("disable_event",))
+
+    def wait_on_event(self, event_type, timeout):
+        self.log.append(("wait_on_event", timeout))
+        if not self.srq_arrives:
+            raise VisaIOError(StatusCode.error_timeout)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def resource(monkeypatch):
+    res = FakeResource()
+    rm = type("FakeRM", (), {"open_resource": lambda self, name: res})()
+    monkeypatch.setattr(dtd, "_get_rm", lambda: rm)
+    return res
+
+
+def test_visa_timeout_raises_builtin(resource):
+    transport = dtd._PyvisaTransport(resource.resource_name, 0.1)
+    resource.query_error = VisaIOError(StatusCode.error_timeout)
+
+    with pytest.raises(TimeoutError):
+        transport.query("*IDN?")
+
+
+def test_visa_other_errors_propagate(resource):
+    transport = dtd._PyvisaTransport(resource.resource_name, 0.1)
+    resource.query_error = VisaIOError(StatusCode.error_connection_lost)
+
+    with pytest.raises(VisaIOError):
+        transport.query("*IDN?")
+
+
+def test_visa_wait_opc_uses_srq(resource):
+    transport = dtd._PyvisaTransport(resource.resource_name, 0.1)
+    resource.log.clear()
+
+    transport.wait_opc()
+
+    # ESR is cleared before *OPC so a stale OPC bit can't mask the SRQ edge
+    assert resource.log == [
+        ("q", "*ESR?"),
+        ("discard_events",),
+        ("w", "*OPC"),
+        ("wait_on_event", 100),
+    ]
+
+
+def test_visa_wait_opc_without_srq_support(resource):
+    resource.srq_supported = False
+    transport = dtd._PyvisaTransport(resource.resource_name, 0.1)
+    resource.log.clear()
+
+    transport.wait_opc()
+
+    assert resource.log == [("q", "*OPC?")]
+
+
+def test_visa_srq_probe_falls_back(resource):
+    resource.srq_arrives = False  # accepts the setup, never interrupts
+    transport = dtd._PyvisaTransport(resource.resource_name, 0.1)
+
+    assert ("disable_event",) in resource.log
+    assert resource.timeout == 100  # probe timeout restored
+    resource.log.clear()
+
+    transport.wait_opc()
+
+    assert resource.log == [("q", "*OPC?")]